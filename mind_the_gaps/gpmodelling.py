@@ -15,7 +15,7 @@ from celerite.modeling import ConstantModel
 from mind_the_gaps.models import LinearModel, GaussianModel
 import emcee
 from multiprocessing import Pool
-from functools import partial
+from multiprocessing.shared_memory import SharedMemory
 from scipy.optimize import minimize
 import warnings
 
@@ -45,18 +45,25 @@ class GPModelling:
             Available implementations are Constant, Linear and Gaussian.
         """
         self._lightcurve = lightcurve
+        self._mean_model = mean_model
+        # avoid dereferencing the lightcurve property on every likelihood call
+        self._y = np.ascontiguousarray(self._lightcurve.y, dtype=np.float64)
 
         meanmodel, fit_mean = self._build_mean_model(mean_model)
 
         self.gp = celerite.GP(kernel, mean=meanmodel, fit_mean=fit_mean)
         # self.gp = GaussianProcess(kernel, self._lightcurve.times, diag=self._lightcurve.dy**2) --> Tiny GP
         # initialize GP ( # You always need to call compute once.)
-        self.gp.compute(self._lightcurve.times, self._lightcurve.dy + 1e-12)
+        self._yerr = self._lightcurve.dy + 1e-12
+        self.gp.compute(self._lightcurve.times, self._yerr)
         self.initial_params = self.gp.get_parameter_vector()
         self._ndim = len(self.initial_params)
-        self._autocorr = []
+        self._lower_bounds, self._upper_bounds = _bounds_to_arrays(self.gp.get_parameter_bounds())
+        self._autocorr = np.empty(0)
+        self._nautocorr = 0
         self._loglikelihoods = None
         self._mcmc_samples = None
+        self._pool = None
 
 
     def _build_mean_model(
@@ -96,17 +103,6 @@ class GPModelling:
             return meanmodel, True
 
         elif meanmodel.lower()=="linear":
-            slope_guess = np.sign(self._lightcurve.y[-1] - self._lightcurve.y[0])
-            minindex = np.argmin(self._lightcurve.times)
-            maxindex = np.argmax(self._lightcurve.times)
-            slope_bound = (self._lightcurve.y[maxindex] - self._lightcurve.y[minindex]) / (self._lightcurve.times[maxindex] - self._lightcurve.times[minindex])
-            if slope_guess > 0 :
-                min_slope = slope_bound
-                max_slope = -slope_bound
-            else:
-                min_slope = -slope_bound
-                max_slope = slope_bound
-            slope = np.cov(self._lightcurve.times, self._lightcurve.y)[0, 1] / np.var(self._lightcurve.times)
             meanmodel = LinearModel(0, 1.5,
                                     bounds=[(-np.inf, np.inf), (-np.inf, np.inf)])
             meanlabels = ["$m$", "$b$"]
@@ -132,10 +128,6 @@ class GPModelling:
         ----------
         params
             List of parameters of the GP at which to calculate the posteriors
-        y: ArrayLike
-            The dataset (count rates, lightcurves, etc)
-        gp: celerite.GP
-            An instance of the Gaussian Process solver
 
         Returns
         -------
@@ -143,18 +135,68 @@ class GPModelling:
             Returns the log of the posterior
             https://celerite.readthedocs.io/en/stable/tutorials/modeling/
         """
+        params = np.asarray(params, dtype=np.float64)
+        # reject out of bounds parameters before going through celerite's per-parameter prior
+        if np.any(params < self._lower_bounds) or np.any(params > self._upper_bounds):
+            return -np.inf
+        return self._log_probability_in_bounds(params)
+
+
+    def _log_probability_in_bounds(self, params: ArrayLike) -> float:
+        """
+        Logarithm of the posteriors of the Gaussian process, without checking the parameter bounds first
+
+        Used where the bounds have already been checked (e.g. for the whole batch of walkers). Out of bounds
+        parameters still get a -inf posterior through celerite's prior, only more slowly.
 
+        Parameters
+        ----------
+        params
+            Float64 array of parameters of the GP at which to calculate the posteriors
+
+        Returns
+        -------
+        float
+            Returns the log of the posterior
+        """
         self.gp.set_parameter_vector(params)
 
         lp = self.gp.log_prior()
         if not np.isfinite(lp):
             return -np.inf
-        return lp + self.gp.log_likelihood(self._lightcurve.y)
+        return lp + self.gp.log_likelihood(self._y)
+
+
+    def _log_probability_batch(self, params: ArrayLike) -> ArrayLike:
+        """
+        Logarithm of the posteriors of the Gaussian process for all walkers at once
+
+        Walkers outside the parameter bounds are rejected with a single vectorized check, so the GP is
+        only evaluated for the remaining ones (by the worker pool, if any).
+
+        Parameters
+        ----------
+        params
+            Array of parameters with shape (walkers, ndim)
+
+        Returns
+        -------
+        ArrayLike
+            Returns the log of the posterior of each walker
+        """
+        log_probs = np.full(len(params), -np.inf)
+        inside = np.all((params >= self._lower_bounds) & (params <= self._upper_bounds), axis=1)
+        if np.any(inside):
+            if self._pool is None:
+                log_probs[inside] = list(map(self._log_probability_in_bounds, params[inside]))
+            else:
+                log_probs[inside] = self._pool.map(_log_probability_worker, params[inside])
+        return log_probs
 
 
     def _neg_log_like(self, params):
         self.gp.set_parameter_vector(params)
-        return -self.gp.log_likelihood(self._lightcurve.y)
+        return -self.gp.log_likelihood(self._y)
 
 
     def fit(
@@ -190,7 +232,8 @@ class GPModelling:
             convergence_steps: int = 500,
             walkers: int = 12,
             cores: int = 6,
-            progress: bool = True
+            progress: bool = True,
+            backend_file: str = None
     ):
         """
         Derive GP Posteriors
@@ -211,6 +254,9 @@ class GPModelling:
             Number of walkers for the chains
         cores:
             Number of cores for parallelization
+        backend_file:
+            HDF5 file where to store the chains as they are sampled (requires h5py), so they are not kept in memory.
+            Any existing chains in the file are overwritten. If not given the chains are stored in memory
         """
         # set the initial parameters if not given
         if initial_chain_params is None:
@@ -221,38 +267,71 @@ class GPModelling:
                 solution = self.fit(self.initial_params)
                 initial_params = solution.x
         
-            initial_chain_params = self.spread_walkers(walkers, initial_params, np.array(self.gp.get_parameter_bounds()))
+            initial_chain_params = self.spread_walkers(walkers, initial_params,
+                                                       np.column_stack((self._lower_bounds, self._upper_bounds)))
         
         every_samples = convergence_steps
         # This will be useful to testing convergence
         old_tau = np.inf
-        # parallelize only if cores > 1
-        pool =  Pool(cores) if cores >1 else None   
-        self.converged = False
-        sampler = emcee.EnsembleSampler(walkers, self._ndim, self._log_probability, pool=pool)
-        for sample in sampler.sample(initial_chain_params, iterations=max_steps, progress=progress):
-            # Only check convergence every 100 steps
-            if sampler.iteration % every_samples:
-                continue
-
-            # Compute the autocorrelation time so far
-            # Using tol=0 means that we'll always get an estimate even
-            # if it isn't trustworthy
-            tau = sampler.get_autocorr_time(tol=0)
-            self.autocorr.append(np.mean(tau))
-
-            # Check convergence
-            if np.all(tau * 100 < sampler.iteration) and np.all(np.abs(old_tau - tau) / tau < 0.01) and converge:
-                print("Convergence reached after %d samples!" % sampler.iteration)
-                self.converged = True
-                break
-            old_tau = tau
-        if pool is not None:
-            pool.close()
-            pool.join() # Ensures all worker processes are cleaned up
+        shm = None
+        try:
+            # parallelize only if cores > 1
+            if cores > 1:
+                # place the data in shared memory and build one GP per worker, so
+                # neither self nor the arrays are pickled on every likelihood call
+                data = np.array([self._lightcurve.times, self._y, self._lightcurve.dy], dtype=np.float64)
+                shm = SharedMemory(create=True, size=data.nbytes)
+                np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+                self._pool = Pool(cores, initializer=_init_worker,
+                                  initargs=(self.gp.kernel, shm.name, data.shape, data.dtype, self._mean_model))
+            else:
+                self._pool = None
+            self.converged = False
+            # one mean autocorrelation time per convergence check
+            self._autocorr = np.empty(max_steps // every_samples + 1)
+            self._nautocorr = 0
+            if backend_file is not None:
+                backend = emcee.backends.HDFBackend(backend_file)
+                backend.reset(walkers, self._ndim)
+            else:
+                backend = None
+            # the sampler passes all walkers at once, and only those within bounds are sent to the pool
+            sampler = emcee.EnsembleSampler(walkers, self._ndim, self._log_probability_batch, vectorize=True,
+                                            backend=backend)
+            for sample in sampler.sample(initial_chain_params, iterations=max_steps, progress=progress):
+                # Only check convergence every 100 steps
+                if sampler.iteration % every_samples:
+                    continue
+
+                # Compute the autocorrelation time so far
+                # Using tol=0 means that we'll always get an estimate even
+                # if it isn't trustworthy
+                tau = sampler.get_autocorr_time(tol=0)
+                mean_tau = tau.mean()
+                self._autocorr[self._nautocorr] = mean_tau
+                self._nautocorr += 1
+
+                # Check convergence (the cheap flag first, then both criteria on their worst parameter)
+                if converge and tau.max() * 100 < sampler.iteration and (np.abs(old_tau - tau) / tau).max() < 0.01:
+                    print("Convergence reached after %d samples!" % sampler.iteration)
+                    self.converged = True
+                    break
+                old_tau = tau
+        except BaseException:
+            # e.g. a LinAlgError from celerite or a KeyboardInterrupt, do not wait for pending tasks
+            if self._pool is not None:
+                self._pool.terminate()
+            raise
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join() # Ensures all worker processes are cleaned up
+                self._pool = None
+            if shm is not None:
+                shm.close()
+                shm.unlink()
 
         self._tau = tau
-        mean_tau = np.mean(tau)
 
         if not self.converged:
             warnings.warn(f"The chains did not converge after {sampler.iteration} iterations!")
@@ -303,35 +382,31 @@ class GPModelling:
         if percent < 0 or percent > 1:
             raise ValueError("The 'percent' parameter must be between 0 and 1 (inclusive).")
 
+        parameters = np.asarray(parameters, dtype=np.float64)
+        ndim = len(parameters)
         std = np.abs(parameters) * percent
-        initial_samples = np.random.normal(parameters, std, size=(walkers, len(parameters)))
-        # Replace None with -inf and inf
-        bounds = np.array([(-np.inf if lower is None else lower, 
-                        np.inf if upper is None else upper) 
-                       for lower, upper in bounds])
-        factors_lower = np.where(bounds[:, 0] > 0, 1.05, 0.95)
-        factors_upper = np.where(bounds[:,1] > 0, 0.95, 1.05)
-
-        for i in range(walkers):
-
-            for attempt in range(max_attempts):
-                # Generate random values centered around the best-fit parameters
-                if np.all(np.logical_and(bounds[:, 0] <= initial_samples[i], initial_samples[i] <= bounds[:, 1])):
-                    break  # If the walker is within bounds, continue to the next walker
-                else:
-                    # Regenerate the walker if it is outside the bounds
-                    initial_samples[i] = np.random.normal(parameters, std)
-            if attempt == max_attempts - 1:
-                warnings.warn("Some walkers are out of bounds! Setting them to values close to the bounds")
-
-                out_of_bounds_lower = initial_samples[i] < bounds[:, 0]
-                out_of_bounds_upper = initial_samples[i] > bounds[:, 1]
-                # Set the values for walkers outside the lower bounds to 1.05 * lower bound
-                
-                initial_samples[i][out_of_bounds_lower] = np.broadcast_to(bounds[:, 0]  * factors_lower , initial_samples[i].shape)[out_of_bounds_lower]
-                # Set the values for walkers outside the upper bounds to 0.95 * upper bound
-                
-                initial_samples[i][out_of_bounds_upper] = np.broadcast_to(bounds[:, 1] * factors_upper, initial_samples[i].shape)[out_of_bounds_upper] 
+        lower, upper = _bounds_to_arrays(bounds)
+
+        initial_samples = np.empty((walkers, ndim))
+        accepted = 0
+        for attempt in range(max_attempts):
+            # Draw a batch of candidates centered around the best-fit parameters and keep those within bounds
+            missing = walkers - accepted
+            candidates = np.random.normal(parameters, std, size=(4 * missing, ndim))
+            inside = candidates[np.all((candidates >= lower) & (candidates <= upper), axis=1)][:missing]
+            initial_samples[accepted:accepted + len(inside)] = inside
+            accepted += len(inside)
+            if accepted == walkers:
+                break
+
+        if accepted < walkers:
+            warnings.warn("Some walkers are out of bounds! Setting them to values close to the bounds")
+            remaining = np.random.normal(parameters, std, size=(walkers - accepted, ndim))
+            # Set the values for walkers outside the lower bounds to 1.05 * lower bound
+            remaining = np.where(remaining < lower, lower * np.where(lower > 0, 1.05, 0.95), remaining)
+            # Set the values for walkers outside the upper bounds to 0.95 * upper bound
+            remaining = np.where(remaining > upper, upper * np.where(upper > 0, 0.95, 1.05), remaining)
+            initial_samples[accepted:] = remaining
         return initial_samples
     
 
@@ -379,12 +454,11 @@ class GPModelling:
         if burnin is None:
             # discard 10 times the mean autocorrelation time
             burnin = int(np.mean(self.tau)) * 10
-        samples = self._sampler.get_chain(discard=burnin)
+        samples = self._sampler.get_chain(discard=burnin) # this has nsteps, nwalkers, ndim
 
         whithin_chain_variances = np.var(samples, axis=0) # this has nwalkers, ndim (one per chain and param)
-
-        samples = self._sampler.get_chain(flat=True, discard=burnin)
-        between_chain_variances = np.var(samples, axis=0)
+        # flatten the same chain rather than asking the sampler for a second copy
+        between_chain_variances = np.var(samples.reshape(-1, samples.shape[-1]), axis=0)
         return whithin_chain_variances / between_chain_variances[np.newaxis, :]
 
     @property
@@ -395,7 +469,8 @@ class GPModelling:
 
     @property
     def autocorr(self):
-        return self._autocorr
+        """The mean autocorrelation time of the chains at each convergence check"""
+        return self._autocorr[:self._nautocorr]
 
     @property
     def sampler(self):
@@ -488,20 +563,120 @@ class GPModelling:
         param_samples = self._mcmc_samples[np.random.randint(len(self._mcmc_samples), size=nsims)]
         # generate the simulator object, with a dummy kernel params for now
         simulator = self._lightcurve.get_simulator(self.gp.kernel.get_psd, pdf, sigma_noise=sigma_noise, extension_factor=extension_factor)
+        # only the kernel parameters are needed to define the PSD
+        current_params = self.gp.get_parameter_vector()
+        kernel_samples = []
+        for parameters in param_samples:
+            self.gp.set_parameter_vector(parameters)
+            kernel_samples.append(self.gp.kernel.get_parameter_vector())
+        self.gp.set_parameter_vector(current_params)
         warnings.simplefilter('ignore')
-        with Pool(processes=cpus, initializer=np.random.seed) as pool:
-            lightcurves = pool.map(partial(self._generate_lc_from_params, simulator=simulator), param_samples)
-        return lightcurves
-    
-    def _generate_lc_from_params(
-            self,
-            parameters: ArrayLike,
-            simulator,
-    ) -> GappyLightcurve:
-        self.gp.set_parameter_vector(parameters)
-        # set the new PSD with update params
-        simulator.psd_model = self.gp.kernel.get_psd
-        rates = simulator.generate_lightcurve()
-        noisy_rates, dy = simulator.add_noise(rates)
-        lc = GappyLightcurve(self._lightcurve.times, noisy_rates, dy)
-        return lc
\ No newline at end of file
+        # the kernel and simulator are sent once per worker and only the rates are sent back
+        with Pool(processes=cpus, initializer=_init_simulation_worker, initargs=(self.gp.kernel, simulator)) as pool:
+            simulations = list(pool.imap_unordered(_generate_rates_worker, kernel_samples,
+                                                   chunksize=max(1, nsims // (cpus * 4))))
+        return [GappyLightcurve(self._lightcurve.times, noisy_rates, dy) for noisy_rates, dy in simulations]
+
+
+def _bounds_to_arrays(bounds: List[Tuple[float, float]]) -> Tuple[ArrayLike, ArrayLike]:
+    """
+    Convert a list of (min, max) bounds into arrays of lower and upper bounds, replacing None with -inf and inf
+
+    Parameters
+    ----------
+    bounds
+        Bounds (min, max) for each of the parameters. A float array of shape (n, 2) is used as is
+
+    Returns
+    -------
+    ArrayLike
+        The lower bounds
+    ArrayLike
+        The upper bounds
+    """
+    if isinstance(bounds, np.ndarray) and bounds.dtype.kind == "f":
+        return bounds[:, 0], bounds[:, 1]
+    lower = np.array([-np.inf if low is None else low for low, _ in bounds], dtype=np.float64)
+    upper = np.array([np.inf if up is None else up for _, up in bounds], dtype=np.float64)
+    return lower, upper
+
+
+# State of each worker process of the Pools used in GPModelling
+_worker_state = {}
+
+
+def _init_worker(
+        kernel,
+        shm_name: str,
+        shape: Tuple[int, int],
+        dtype: np.dtype,
+        mean_model: str = None
+):
+    """
+    Initialize a worker process by building its own GPModelling from the data in shared memory
+
+    Parameters
+    ----------
+    kernel: celerite.terms.Term
+        The model to be fitted to the lightcurve
+    shm_name
+        Name of the shared memory block holding the times, y and dy arrays (in that order)
+    shape
+        Shape of the array stored in the shared memory block
+    dtype
+        Data type of the array stored in the shared memory block
+    mean_model
+        Mean model, as given to GPModelling
+    """
+    shm = SharedMemory(name=shm_name)
+    times, y, dy = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    # keep a reference to the block so the buffer remains valid
+    _worker_state["shm"] = shm
+    _worker_state["model"] = GPModelling(GappyLightcurve(times, y, dy), kernel, mean_model)
+
+
+def _log_probability_worker(params: ArrayLike) -> float:
+    """Logarithm of the posteriors evaluated with the GP of the current worker process (bounds already checked)"""
+    return _worker_state["model"]._log_probability_in_bounds(np.asarray(params, dtype=np.float64))
+
+
+def _init_simulation_worker(kernel, simulator):
+    """
+    Initialize a worker process for GPModelling.generate_from_posteriors
+
+    Parameters
+    ----------
+    kernel: celerite.terms.Term
+        The kernel whose PSD is used for the simulations
+    simulator: Simulator
+        The simulator of the lightcurve
+    """
+    # reseed from fresh entropy, otherwise forked workers share the parent's random state
+    np.random.seed()
+    _worker_state["kernel"] = kernel
+    _worker_state["simulator"] = simulator
+
+
+def _generate_rates_worker(kernel_parameters: ArrayLike) -> Tuple[ArrayLike, ArrayLike]:
+    """
+    Simulate the rates and uncertainties of a lightcurve with the kernel parameters given
+
+    Parameters
+    ----------
+    kernel_parameters
+        Parameters of the kernel of the current worker
+
+    Returns
+    -------
+    ArrayLike
+        The simulated (noisy) rates
+    ArrayLike
+        The uncertainties on the rates
+    """
+    kernel = _worker_state["kernel"]
+    simulator = _worker_state["simulator"]
+    kernel.set_parameter_vector(kernel_parameters)
+    # set the new PSD with update params
+    simulator.psd_model = kernel.get_psd
+    rates = simulator.generate_lightcurve()
+    return simulator.add_noise(rates)
@@ -7,7 +7,6 @@ import numpy as np
 from typing import List, Union
 from numpy import floating
 from numpy.typing import ArrayLike, NDArray
-from random import sample
 from mind_the_gaps.simulator import Simulator
 from astropy.modeling import Model as AstropyModel
 
@@ -48,16 +47,17 @@ class GappyLightcurve:
             uncertainty on background rate
 
         """
-        self._times = times
-        self._y = y
-        self._dy = dy
+        # store contiguous float64 arrays so they are not repacked by the GP solvers
+        self._times = np.ascontiguousarray(times, dtype=np.float64)
+        self._y = np.ascontiguousarray(y, dtype=np.float64)
+        self._dy = np.ascontiguousarray(dy, dtype=np.float64) if dy is not None else None
 
         # exposures were given
         if exposures is not None:
             if np.isscalar(exposures):
-                self._exposures = np.full(len(times), exposures)
+                self._exposures = np.full(len(times), exposures, dtype=np.float64)
             else:
-                self._exposures = exposures
+                self._exposures = np.ascontiguousarray(exposures, dtype=np.float64)
             epsilon = 1.01 # to avoid numerically distinct but equal
             wrong = np.count_nonzero(np.diff(self._times) < self._exposures[:-1] * epsilon / 2 )
             if wrong >0:
@@ -66,8 +66,8 @@ class GappyLightcurve:
         else:
             self._exposures = np.zeros(len(times))
 
-        self._bkg_rate = bkg_rate if bkg_rate is not None else np.zeros(len(times))
-        self._bkg_rate_err = bkg_rate_err if bkg_rate_err is not None else np.zeros(len(times))
+        self._bkg_rate = np.ascontiguousarray(bkg_rate, dtype=np.float64) if bkg_rate is not None else np.zeros(len(times))
+        self._bkg_rate_err = np.ascontiguousarray(bkg_rate_err, dtype=np.float64) if bkg_rate_err is not None else np.zeros(len(times))
 
     @property
     def times(self) -> ArrayLike:
@@ -223,16 +223,12 @@ class GappyLightcurve:
         List[GappyLightcurve]
             Each split lightcurve will be stored as a new object
         """
-        lightcurves = []
-        # find places where the spacing is larger than the interval
-        indexes = np.where(np.diff(self.times) > interval)[0]
-        # add last index
-        indexes = np.append(indexes, -1)
-        j = 0
-        for i in indexes:
-            lightcurves.append(self.truncate(self.times[j], self.times[i]))
-            j = i + 1
-        return lightcurves
+        # find places where the spacing is larger than the interval (start of each new segment)
+        indexes = np.where(np.diff(self._times) > interval)[0] + 1
+        # split each array once (the segments are views) instead of masking the whole lightcurve per segment
+        segments = zip(*(np.split(array, indexes) for array in (self._times, self._y, self._dy, self._exposures,
+                                                                 self._bkg_rate, self._bkg_rate_err)))
+        return [GappyLightcurve(*segment) for segment in segments]
 
     def rand_remove(
             self,
@@ -241,16 +237,15 @@ class GappyLightcurve:
         """Randomly remove a given number of points from the lightcurve"""
         if points_remove > self.n:
             return ValueError("Number of points to remove (%d) is greater than number of lightcurve datapoints (%d)"  % (points_remove, self.n))
-        ints = sample(range(len(self._times)), points_remove)
-        mask = np.ones(len(self._times), dtype=bool)
-        mask[ints] = False
+        # sorted indexes of the points to keep, to preserve the time ordering
+        keep = np.sort(np.random.choice(self.n, self.n - points_remove, replace=False))
         return GappyLightcurve(
-            self._times[mask],
-            self._y[mask],
-            self._dy[mask],
-            self._exposures[mask],
-            self._bkg_rate[mask],
-            self._bkg_rate_err[mask]
+            self._times[keep],
+            self._y[keep],
+            self._dy[keep],
+            self._exposures[keep],
+            self._bkg_rate[keep],
+            self._bkg_rate_err[keep]
         )
 
     def to_csv(
@@ -258,8 +253,9 @@ class GappyLightcurve:
             outname: str
     ):
         """Save lightcurve properties to csv file"""
-        outputs = np.array([self._times, self._y, self._dy, self._exposures, self._bkg_rate, self._bkg_rate_err])
-        np.savetxt(outname, outputs.T, fmt="%.8e\t%.5f\t%.5f\t%.3f\t%.5f\t%.5f", header="t\trate\terror\texposure\tbkg_rate\tbkg_rate_err")
+        # build the (N, 6) array directly so each row is contiguous in memory
+        outputs = np.column_stack((self._times, self._y, self._dy, self._exposures, self._bkg_rate, self._bkg_rate_err))
+        np.savetxt(outname, outputs, fmt="%.8e\t%.5f\t%.5f\t%.3f\t%.5f\t%.5f", header="t\trate\terror\texposure\tbkg_rate\tbkg_rate_err")
 
 
     def get_simulator(
@@ -0,0 +1,47 @@
+from mind_the_gaps.lightcurves import GappyLightcurve
+import unittest
+import numpy as np
+
+
+class TestGappyLightcurve(unittest.TestCase):
+    def test_split(self):
+        times = np.array([0, 1, 2, 10, 11, 20, 30, 31, 32], dtype=float)
+        n = len(times)
+        y = np.arange(n) + 10.
+        dy = np.arange(n) * 0.1
+        exposures = np.full(n, 0.5)
+        bkg_rate = np.arange(n) * 0.01
+        bkg_rate_err = np.arange(n) * 0.001
+        lc = GappyLightcurve(times, y, dy, exposures, bkg_rate, bkg_rate_err)
+
+        lightcurves = lc.split(5)
+
+        # the third segment holds a single point
+        boundaries = [(0, 3), (3, 5), (5, 6), (6, 9)]
+        self.assertEqual(len(lightcurves), len(boundaries))
+        for segment, (start, end) in zip(lightcurves, boundaries):
+            self.assertEqual(segment.n, end - start)
+            self.assertEqual(segment.times[0], times[start])
+            self.assertEqual(segment.times[-1], times[end - 1])
+            np.testing.assert_array_equal(segment.times, times[start:end])
+            np.testing.assert_array_equal(segment.y, y[start:end])
+            np.testing.assert_array_equal(segment.dy, dy[start:end])
+            np.testing.assert_array_equal(segment.exposures, exposures[start:end])
+            np.testing.assert_array_equal(segment.bkg_rate, bkg_rate[start:end])
+            np.testing.assert_array_equal(segment.bkg_rate_err, bkg_rate_err[start:end])
+
+        self.assertEqual(sum(segment.n for segment in lightcurves), lc.n)
+
+    def test_split_no_gaps(self):
+        times = np.arange(10, dtype=float)
+        lc = GappyLightcurve(times, times + 1, np.ones(10))
+
+        lightcurves = lc.split(5)
+
+        self.assertEqual(len(lightcurves), 1)
+        self.assertEqual(lightcurves[0].n, lc.n)
+        np.testing.assert_array_equal(lightcurves[0].times, times)
+
+
+if __name__ == '__main__':
+    unittest.main()
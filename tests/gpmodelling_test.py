@@ -1,8 +1,14 @@
-from mind_the_gaps.gpmodelling import  GPModelling
+from mind_the_gaps.gpmodelling import  GPModelling, _init_worker, _log_probability_worker, _worker_state
 from mind_the_gaps.models import DampedRandomWalk, Lorentzian
 from mind_the_gaps.lightcurves import GappyLightcurve
+from multiprocessing.shared_memory import SharedMemory
+import gc
+import os
+import tempfile
 import unittest
 import numpy as np
+import emcee
+import pytest
 
 
 class TestGPModelling(unittest.TestCase):
@@ -113,6 +119,126 @@ class TestGPModelling(unittest.TestCase):
                 np.all(sample==parameters[i])
             )
 
+    def test_worker_log_probability(self):
+        drw_params = [5.0, 10.0]
+        kernel = DampedRandomWalk(drw_params[0], drw_params[1], bounds=[(4.0, 6.0), (8.0, 12.0)])
+        times = np.arange(100, dtype=float)
+        lc = GappyLightcurve(times, np.sin(times) + 10, np.ones(100))
+        gpmodel = GPModelling(lc, kernel, mean_model="constant")
+
+        data = np.array([lc.times, lc.y, lc.dy])
+        shm = SharedMemory(create=True, size=data.nbytes)
+        try:
+            np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+            _init_worker(kernel, shm.name, data.shape, data.dtype, "constant")
+            for params in [[5.0, 10.0, 10.0], [4.5, 9.0, 10.2], [7.0, 10.0, 10.0]]:
+                self.assertEqual(_log_probability_worker(params), gpmodel._log_probability(params))
+        finally:
+            # the worker model holds views of the shared buffer
+            del _worker_state["model"]
+            gc.collect()
+            _worker_state.pop("shm").close()
+            shm.unlink()
+
+    def test_derive_posteriors_cores(self):
+        bounds = [(4.0, 6.0), (8.0, 12.0)]
+        kernel = DampedRandomWalk(5.0, 10.0, bounds=bounds)
+        times = np.arange(100, dtype=float)
+        lc = GappyLightcurve(times, np.sin(times) + 10, np.ones(100))
+        gpmodel = GPModelling(lc, kernel)
+        initial_chain_params = gpmodel.spread_walkers(8, [5.0, 10.0], np.array(bounds), percent=0.1)
+
+        chains = []
+        for cores in [1, 2]:
+            # same walkers and random state, so both runs must propose the same steps
+            initial_state = emcee.State(initial_chain_params, random_state=np.random.RandomState(42).get_state())
+            gpmodel.derive_posteriors(initial_state, fit=False, converge=False, max_steps=1000,
+                                      convergence_steps=100, walkers=8, cores=cores, progress=False)
+            chains.append(gpmodel.sampler.get_chain())
+        np.testing.assert_array_equal(chains[0], chains[1])
+
+    def test_log_probability_batch(self):
+        kernel = DampedRandomWalk(5.0, 10.0, bounds=[(4.0, 6.0), (None, 12.0)])
+        times = np.arange(100, dtype=float)
+        lc = GappyLightcurve(times, np.sin(times) + 10, np.ones(100))
+        gpmodel = GPModelling(lc, kernel)
+
+        params = np.array([[5.0, 10.0], [4.5, -20.0], [7.0, 10.0], [5.0, 13.0]])
+        log_probs = gpmodel._log_probability_batch(params)
+        self.assertEqual(log_probs.shape, (len(params),))
+        self.assertTrue(np.all(np.isfinite(log_probs[:2])))
+        self.assertTrue(np.all(np.isneginf(log_probs[2:])))
+        for log_prob, param in zip(log_probs, params):
+            self.assertEqual(log_prob, gpmodel._log_probability(param))
+
+    def test_default_mean_predict_and_sample(self):
+        times = np.arange(100, dtype=float)
+        lc = GappyLightcurve(times, np.sin(times) + 10, np.ones(100))
+        gpmodel = GPModelling(lc, DampedRandomWalk(5.0, 10.0, bounds=[(4.0, 6.0), (8.0, 12.0)]))
+
+        pred_mean, pred_var = gpmodel.gp.predict(lc.y, return_var=True, return_cov=False)
+        self.assertEqual(pred_mean.shape, (lc.n,))
+        self.assertEqual(pred_var.shape, (lc.n,))
+        self.assertTrue(np.all(np.isfinite(pred_mean)))
+
+        new_times = np.linspace(0, 99, 30)
+        pred_mean = gpmodel.gp.predict(lc.y, new_times, return_cov=False)
+        self.assertEqual(pred_mean.shape, (len(new_times),))
+
+        samples = gpmodel.gp.sample(size=3)
+        self.assertEqual(samples.shape, (3, lc.n))
+        self.assertTrue(np.all(np.isfinite(samples)))
+
+    def test_backend_file(self):
+        pytest.importorskip("h5py")
+
+        np.random.seed(10)
+        times = np.arange(100, dtype=float)
+        lc = GappyLightcurve(times, np.sin(times) + 10, np.ones(100))
+        gpmodel = GPModelling(lc, DampedRandomWalk(5.0, 10.0, bounds=[(4.0, 6.0), (8.0, 12.0)]))
+        walkers = 8
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backend_file = os.path.join(tmpdir, "chains.h5")
+            gpmodel.derive_posteriors(fit=False, converge=False, max_steps=1000, convergence_steps=100,
+                                      walkers=walkers, cores=1, progress=False, backend_file=backend_file)
+            backend = emcee.backends.HDFBackend(backend_file, read_only=True)
+            self.assertEqual(backend.iteration, 1000)
+            self.assertEqual(backend.get_chain().shape, (1000, walkers, gpmodel.k))
+            np.testing.assert_array_equal(backend.get_chain(), gpmodel.sampler.get_chain())
+            self.assertEqual(gpmodel.mcmc_samples.shape[1], gpmodel.k)
+            self.assertEqual(len(gpmodel.mcmc_samples), len(gpmodel.loglikelihoods))
+            self.assertGreater(len(gpmodel.mcmc_samples), 0)
+            self.assertTrue(np.all(np.isfinite(gpmodel.loglikelihoods)))
+
+            # reusing the file resets the chains instead of appending to them
+            gpmodel.derive_posteriors(fit=False, converge=False, max_steps=600, convergence_steps=100,
+                                      walkers=walkers, cores=1, progress=False, backend_file=backend_file)
+            backend = emcee.backends.HDFBackend(backend_file, read_only=True)
+            self.assertEqual(backend.iteration, 600)
+            self.assertEqual(backend.get_chain().shape, (600, walkers, gpmodel.k))
+
+    def test_generate_from_posteriors(self):
+        np.random.seed(10)
+        times = np.arange(100, dtype=float)
+        lc = GappyLightcurve(times, np.sin(times) + 10, np.ones(100))
+        gpmodel = GPModelling(lc, DampedRandomWalk(5.0, 10.0, bounds=[(4.0, 6.0), (8.0, 12.0)]))
+        gpmodel.derive_posteriors(fit=False, converge=False, max_steps=1000, convergence_steps=100,
+                                  walkers=8, cores=1, progress=False)
+        params = gpmodel.gp.get_parameter_vector()
+
+        lcs = gpmodel.generate_from_posteriors(nsims=4, cpus=2)
+        self.assertEqual(len(lcs), 4)
+        for sim_lc in lcs:
+            self.assertIsInstance(sim_lc, GappyLightcurve)
+            np.testing.assert_array_equal(sim_lc.times, lc.times)
+        # the parameters of the GP are restored after drawing the kernel samples
+        np.testing.assert_array_equal(gpmodel.gp.get_parameter_vector(), params)
+        # every worker draws its own random numbers
+        for i in range(len(lcs)):
+            for j in range(i + 1, len(lcs)):
+                self.assertFalse(np.array_equal(lcs[i].y, lcs[j].y))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file